@@ -10,16 +10,21 @@ Usage:
     python scripts/map_rc_to_slack.py --mongo mongodb://localhost:27017 --db rocketchat --out ./examples/slack_export --csv ./examples/messages_export.csv --json-dir ./examples/slack_export_msgs
 
 Requirements:
-    - MongoDB connection to Rocket.Chat database
+    - MongoDB connection to Rocket.Chat database (MongoDB 5.0+)
     - CSV export of messages (if available)
-    - Python dependencies: pymongo, pandas
+    - Python dependencies: pymongo, pandas, tqdm
+    - Optional: orjson (faster JSON message export)
 """
 
 import argparse
 import json
 import os
+import re
 import sys
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import lru_cache
+from itertools import islice
 from pathlib import Path
 import logging
 
@@ -29,7 +34,7 @@ logger = logging.getLogger(__name__)
 
 try:
     import pymongo
-    from pymongo import MongoClient
+    from pymongo import ASCENDING, MongoClient
 except ImportError:
     logger.error("pymongo is required. Install with: pip install pymongo")
     sys.exit(1)
@@ -40,6 +45,23 @@ except ImportError:
     logger.error("pandas is required. Install with: pip install pandas")
     sys.exit(1)
 
+try:
+    from tqdm import tqdm
+except ImportError:
+    logger.error("tqdm is required. Install with: pip install tqdm")
+    sys.exit(1)
+
+# orjson is optional; it encodes straight to UTF-8 bytes and is much faster
+# than the stdlib encoder. The fallback produces the same compact output.
+try:
+    import orjson
+
+    def encode_json(obj):
+        return orjson.dumps(obj)
+except ImportError:
+    def encode_json(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
 # Initialize global statistics for tracking export progress
 stats = {
     "users": 0,
@@ -55,10 +77,62 @@ stats = {
     }
 }
 
+# Fields read from each collection; projecting keeps large unused
+# fields (md, urls, _updatedAt, ...) off the wire
+USER_FIELDS = {"_id": 1, "username": 1, "name": 1, "active": 1, "emails": 1}
+ROOM_FIELDS = {"_id": 1, "name": 1, "t": 1, "ts": 1, "archived": 1, "usernames": 1}
+MESSAGE_FIELDS = {"_id": 1, "rid": 1, "u": 1, "ts": 1, "msg": 1,
+                  "attachments": 1, "file": 1, "files": 1, "reactions": 1}
+
+# Characters not allowed in Slack channel names
+_SLUG_RE = re.compile(r'[^a-z0-9_-]')
+
+# Unix epoch, for converting MongoDB datetimes without timestamp()
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_EPOCH_NAIVE = datetime(1970, 1, 1)
+
 # ---------- Helper Functions ----------
+@lru_cache(maxsize=None)
 def slug(name):
     """Convert Rocket.Chat name to a Slack-safe channel name"""
-    return re.sub(r'[^a-z0-9_-]', '-', name.lower())[:80]
+    return _SLUG_RE.sub('-', name.lower())[:80]
+
+def to_epoch(dt):
+    """
+    Convert a MongoDB datetime to a Unix timestamp.
+    
+    pymongo returns naive datetimes that hold UTC, so they are measured
+    against a naive epoch rather than passed to timestamp(), which would
+    treat them as local time.
+    
+    Args:
+        dt: Naive (UTC) or timezone-aware datetime
+        
+    Returns:
+        int: Seconds since the Unix epoch
+    """
+    if dt.tzinfo is None:
+        return int((dt - _EPOCH_NAIVE).total_seconds())
+    return int((dt - _EPOCH).total_seconds())
+
+def channel_name(rc_room):
+    """
+    Derive the channel name messages from a Rocket.Chat room are exported to.
+    
+    Args:
+        rc_room: Room document from Rocket.Chat MongoDB
+        
+    Returns:
+        str: Channel name used for the room's CSV file and JSON records
+    """
+    # For rooms with names
+    if "name" in rc_room:
+        return slug(rc_room["name"])
+    # For direct messages without names
+    if "usernames" in rc_room:
+        return slug("-".join(sorted(rc_room["usernames"])))
+    # Fallback to ID
+    return f"dm-{rc_room['_id']}"
 
 def make_user_entry(rc_user, uid):
     """
@@ -71,14 +145,14 @@ def make_user_entry(rc_user, uid):
     Returns:
         dict: User entry in Slack import format
     """
-    # Try to extract email with different possible structures
+    # Extract the first email; Rocket.Chat stores emails either as a list
+    # or as a dict keyed by index ({"0": {"address": ...}})
     email = ""
-    if "emails" in rc_user:
-        emails = rc_user.get("emails")
-        if isinstance(emails, list) and len(emails) > 0 and "address" in emails[0]:
-            email = emails[0]["address"]
-        elif isinstance(emails, dict) and "0" in emails and "address" in emails["0"]:
-            email = emails["0"]["address"]
+    emails = rc_user.get("emails")
+    if emails:
+        first = emails[0] if isinstance(emails, list) else emails.get("0")
+        if first:
+            email = first.get("address") or ""
     
     return {
         "id": f"U{uid:07d}",             # placeholder; Slack will re-ID
@@ -115,78 +189,157 @@ def make_room_entry(rc_room, is_private):
     return {
         "id": f"C{rc_room['_id']}",      # placeholder
         "name": slug(room_name),
-        "created": int(rc_room["ts"].timestamp()),
+        "created": to_epoch(rc_room["ts"]),
         "is_archived": bool(rc_room.get("archived")),
         "is_private": is_private,
         # Slack ignores members on import, but include for completeness
     }
 
 # Add CSV message formatting functions
-def escape_for_csv(text):
-    """
-    Properly escape text for CSV format according to Slack import requirements:
-    - Double quotes need to be escaped with another double quote
-    - Preserve backslashes for proper escaping
-    - Preserve newlines within quoted text
-    - Handle @mentions properly
-    """
-    if text is None:
-        return ""
-        
-    # First, handle double quotes by replacing with two double quotes
-    # This is the CSV standard for escaping quotes
-    escaped_text = text.replace('"', '""')
-    
-    # Keep backslashes as is - they'll be treated as escape characters in Slack
-    # No special handling needed as we're already escaping double quotes with double quotes
-    
-    # @mentions are passed through as is (they're handled by Slack importer)
-    
-    return escaped_text
-
 def prepare_message_for_csv(text, max_length=4000):
     """
     Prepare message text for CSV export with proper formatting.
     
     This function:
     1. Escapes text for CSV format according to Slack import requirements
+       (double quotes are doubled; backslashes, newlines and @mentions are
+       passed through as is)
     2. Splits long messages into parts if they exceed max_length characters
     
     Args:
-        text: The message text to process
+        text: Message text as returned by process_message_content
         max_length: Maximum length per message part (default: 4000)
         
     Returns:
-        list: A list of processed message parts ready for CSV export
+        tuple: The processed message parts ready for CSV export
     """
     if not text:
-        return [""]
-        
-    # Escape double quotes for CSV
-    escaped_text = text.replace('"', '""')
+        return ("",)
     
-    # If text fits within limit, return as single part
-    if len(escaped_text) <= max_length:
-        return [escaped_text]
+    # If text fits within limit, return it escaped as a single part
+    if len(text) <= max_length:
+        return (text.replace('"', '""'),)
     
-    # Otherwise, split into parts
+    # Otherwise, split into parts. The raw text is split before escaping so
+    # a doubled quote is never cut in half at a part boundary.
     parts = []
-    total_length = len(escaped_text)
+    total_length = len(text)
     num_parts = (total_length + max_length - 1) // max_length  # Ceiling division
     
     for i in range(num_parts):
         start = i * max_length
         end = min(start + max_length, total_length)
         
-        # Extract this segment and add part indicator
-        segment = escaped_text[start:end]
+        # Extract and escape this segment
+        segment = text[start:end].replace('"', '""')
         
         # Add part indicator at beginning so it doesn't get cut off
         part_with_indicator = f"[Part {i+1}/{num_parts}] {segment}"
         
         parts.append(part_with_indicator)
     
-    return parts
+    return tuple(parts)
+
+def format_csv_row(timestamp, channel, username, text):
+    """
+    Format one Slack import CSV row without going through the csv module.
+    
+    Channel names are slugs or room IDs and never need quoting. Usernames
+    may come from deleted users or livechat visitors, or from a customized
+    username pattern, so they are quoted and escaped like the text. The text
+    must already be escaped by prepare_message_for_csv.
+    
+    Args:
+        timestamp: Unix timestamp of the message
+        channel: Slack-safe channel name
+        username: Username of the message author
+        text: Escaped message text
+        
+    Returns:
+        str: A complete CSV row, including the trailing newline
+    """
+    username = username.replace('"', '""')
+    return f'{timestamp},{channel},"{username}","{text}"\n'
+
+def write_all(fd, data):
+    """
+    Write all of data to a raw file descriptor.
+    
+    os.write may write fewer bytes than requested, so keep writing the
+    remainder until everything is on disk. The remainder is sliced from a
+    memoryview so it is not copied.
+    """
+    with memoryview(data) as view:
+        written = os.write(fd, view)
+        while written < len(view):
+            written += os.write(fd, view[written:])
+
+def flush_channel(open_fds, channel_files, channel, max_open):
+    """
+    Write a channel's buffered CSV rows to its file and empty the buffer.
+    
+    open_fds is kept in least-recently-used order; once max_open descriptors
+    are open the oldest one is flushed and closed, so exports with thousands
+    of channels do not run out of file descriptors. A file that was opened
+    before is reopened in append mode so earlier rows are kept.
+    
+    Args:
+        open_fds: OrderedDict mapping channel names to open descriptors
+        channel_files: Maps channel names to their buffer, path and state
+        channel: Channel name
+        max_open: Maximum number of descriptors to keep open
+        
+    Returns:
+        int: Number of buffered bytes written, including any written for
+        the channel whose descriptor was evicted
+    """
+    channel_info = channel_files[channel]
+    buf = channel_info['buf']
+    if not buf:
+        return 0
+    written = len(buf)
+    
+    fd = open_fds.get(channel)
+    if fd is not None:
+        open_fds.move_to_end(channel)
+    else:
+        if len(open_fds) >= max_open:
+            evicted, evicted_fd = open_fds.popitem(last=False)
+            evicted_buf = channel_files[evicted]['buf']
+            if evicted_buf:
+                written += len(evicted_buf)
+                write_all(evicted_fd, evicted_buf)
+                evicted_buf.clear()
+            os.close(evicted_fd)
+        
+        flags = os.O_WRONLY | os.O_CREAT | (os.O_APPEND if channel_info['opened'] else os.O_TRUNC)
+        fd = open_fds[channel] = os.open(channel_info['path'], flags, 0o644)
+        channel_info['opened'] = True
+    
+    write_all(fd, buf)
+    buf.clear()
+    return written
+
+def flush_largest_channels(open_fds, channel_files, buffered, target, max_open):
+    """
+    Flush the largest channel buffers until at most target bytes remain.
+    
+    Args:
+        open_fds: OrderedDict mapping channel names to open descriptors
+        channel_files: Maps channel names to their buffer, path and state
+        buffered: Total bytes currently buffered across all channels
+        target: Number of buffered bytes to get down to
+        max_open: Maximum number of descriptors to keep open
+        
+    Returns:
+        int: Total bytes still buffered
+    """
+    by_size = sorted(channel_files, key=lambda ch: len(channel_files[ch]['buf']), reverse=True)
+    for channel in by_size:
+        if buffered <= target:
+            break
+        buffered -= flush_channel(open_fds, channel_files, channel, max_open)
+    return buffered
 
 def process_message_content(msg):
     """
@@ -205,289 +358,334 @@ def process_message_content(msg):
     Returns:
         str: Processed message content ready for export
     """
-    content = msg.get('msg', '')
-    
-    # Handle mentions already in the message
-    if 'mentions' in msg and msg['mentions']:
-        # This is just for tracking - the mentions are already in the text
-        # as @username format, we just need to preserve them
-        pass
+    # Collect the non-empty pieces and join them once at the end, rather than
+    # growing a string with += for every attachment, file and reaction.
+    # Mentions need no handling: they are already in the text as @username.
+    content = msg.get('msg')
+    parts = [content] if content else []
     
     # Handle attachments
     if 'attachments' in msg and msg['attachments']:
         for attachment in msg['attachments']:
             # Add attachment description if available
             if 'description' in attachment and attachment['description']:
-                if content:
-                    content += "\n"
-                # If description contains mention markdown, preserve it
-                desc = attachment.get('description', '')
-                if 'descriptionMd' in attachment:
-                    for md_item in attachment['descriptionMd']:
-                        if md_item.get('type') == 'MENTION_USER':
-                            # Replace placeholder with proper @mention format
-                            user_value = md_item.get('value', {}).get('value', '')
-                            desc = desc.replace(f"@{user_value}", f"@{user_value}")
-                
-                content += f"[Attachment: {desc}]"
+                parts.append(f"[Attachment: {attachment['description']}]")
             elif 'title' in attachment:
-                if content:
-                    content += "\n"
-                content += f"[Attachment: {attachment.get('title', '')}]"
+                parts.append(f"[Attachment: {attachment.get('title', '')}]")
     
     # Handle files
     if 'file' in msg and msg['file']:
-        file_info = msg['file']
-        if content:
-            content += "\n"
-        content += f"[File: {file_info.get('name', '')}]"
+        parts.append(f"[File: {msg['file'].get('name', '')}]")
     elif 'files' in msg and msg['files']:
         for file_info in msg['files']:
-            if 'thumb-' not in file_info.get('name', ''):  # Skip thumbnails
-                if content:
-                    content += "\n"
-                content += f"[File: {file_info.get('name', '')}]"
+            name = file_info.get('name', '')
+            if not name.startswith('thumb-'):  # Skip thumbnails
+                parts.append(f"[File: {name}]")
     
     # Handle reactions
     if 'reactions' in msg and msg['reactions']:
-        reactions_text = []
-        for emoji, data in msg['reactions'].items():
-            if 'usernames' in data:
-                usernames = data['usernames']
-                reactions_text.append(f"{emoji} ({', '.join(usernames)})")
-        
+        reactions_text = [f"{emoji} ({', '.join(data['usernames'])})"
+                          for emoji, data in msg['reactions'].items()
+                          if 'usernames' in data]
         if reactions_text:
-            if content:
-                content += "\n"
-            content += f"[Reactions: {' | '.join(reactions_text)}]"
+            parts.append(f"[Reactions: {' | '.join(reactions_text)}]")
     
-    return content
+    return "\n".join(parts)
 
-# ---------- Main Script ----------
-# Parse command line arguments
-ap = argparse.ArgumentParser(description="Convert Rocket.Chat data to Slack import format")
-ap.add_argument("--mongo", default="mongodb://localhost:27017",
-                help="MongoDB connection URI (default: mongodb://localhost:27017)")
-ap.add_argument("--db", default="rocketchat",
-                help="Database name containing Rocket.Chat collections (default: rocketchat)")
-ap.add_argument("--out", default="./slack_export_core",
-                help="Output directory for Slack import JSON files (default: ./slack_export_core)")
-ap.add_argument("--csv", default="./messages_export.csv",
-                help="Output CSV file for messages (default: ./messages_export.csv)")
-ap.add_argument("--json-dir", default=None,
-                help="Output directory for JSON message files (optional)")
-args = ap.parse_args()
-
-# Initialize output directories and database connection
-out_dir = Path(args.out).expanduser()
-out_dir.mkdir(parents=True, exist_ok=True)
-
-client = MongoClient(args.mongo)
-db = client[args.db]
-
-# Display diagnostic information about the database
-print(f"Connected to database: {args.mongo}/{args.db}")
-print(f"Available collections: {', '.join(db.list_collection_names())}")
-print(f"Total users: {db.users.count_documents({})}")
-print(f"Total rooms: {db.rocketchat_room.count_documents({})}")
-print(f"Total messages: {db.rocketchat_message.count_documents({})}")
-
-# Export Phase 1: Users to Slack format
-print("\\nPhase 1: Exporting users to Slack format...")
-slack_users = []
-for idx, u in enumerate(tqdm(db.users.find().sort("username", ASCENDING)), 1):
-    slack_users.append(make_user_entry(u, idx))
-    stats["users"] += 1
-    
-# Create user ID mapping for message processing
-(uid_map := {}).update({u["_id"]: slack_users[i]["id"]
-                        for i, u in enumerate(db.users.find().sort("username", ASCENDING))})
-(out_dir / "users.json").write_text(json.dumps(slack_users, indent=2))
-
-# Export Phase 2: Rooms/Channels to Slack format
-print("\\nPhase 2: Exporting rooms and channels...")
-# Categorize rooms by type for Slack import
-rooms_by_type = {
-    "channels.json": [],  # Public channels
-    "groups.json": [],    # Private groups  
-    "dms.json": [],       # Direct messages
-    "mpims.json": []      # Multi-party instant messages
-}
-
-# Process each room and categorize by type
-for r in tqdm(db.rocketchat_room.find()):
-    if r["t"] == "c":                     # public channel
-        rooms_by_type["channels.json"].append(make_room_entry(r, False))
-        stats["channels"]["public"] += 1
-    elif r["t"] == "p":                   # private group
-        rooms_by_type["groups.json"].append(make_room_entry(r, True))
-        stats["channels"]["private"] += 1
-    elif r["t"] == "d":                   # direct message
-        rooms_by_type["dms.json"].append(make_room_entry(r, True))
-        stats["channels"]["dm"] += 1
-    elif r["t"] == "l":                   # group DM (livechat/mpim)
-        rooms_by_type["mpims.json"].append(make_room_entry(r, True))
-        stats["channels"]["group_dm"] += 1
-
-# Write room data to separate JSON files
-for filename, data in rooms_by_type.items():
-    if data:
-        (out_dir / filename).write_text(json.dumps(data, indent=2))
-
-# Export Phase 3: Messages to CSV format
-print("\\nPhase 3: Exporting messages to CSV format...")
-
-# Create mapping tables for efficient message processing
-
-# Map room IDs to channel names for message organization
-room_map = {}
-for r in db.rocketchat_room.find():
-    # For rooms with names
-    if 'name' in r:
-        room_map[r['_id']] = slug(r['name'])
-    # For direct messages without names
-    elif 'usernames' in r:
-        room_map[r['_id']] = slug("-".join(sorted(r['usernames'])))
-    # Fallback to ID
-    else:
-        room_map[r['_id']] = f"dm-{r['_id']}"
-
-# Create user mapping tables for message attribution
-username_map = {}  # Maps user IDs to usernames
-email_map = {}     # Maps user IDs to email addresses
-
-for u in db.users.find():
-    # Store username for message attribution
-    username_map[u['_id']] = u['username']
+def format_message_batch(msgs, with_json, channel_cache):
+    """
+    Convert a batch of Rocket.Chat messages to CSV rows and JSON lines.
     
-    # Extract email using Rocket.Chat's email storage structure
-    # Format: {emails: {0: {address: email}}} or list format
-    if 'emails' in u and u['emails'] is not None:
-        if isinstance(u['emails'], dict) and '0' in u['emails']:
-            if 'address' in u['emails']['0']:
-                email_map[u['_id']] = u['emails']['0']['address']
-        # Also try the list format as a fallback
-        elif isinstance(u['emails'], list) and len(u['emails']) > 0:
-            if 'address' in u['emails'][0]:
-                email_map[u['_id']] = u['emails'][0]['address']
-
-# Configuration for CSV file organization
-ROWS_PER_FILE = 2000  # Maximum rows per CSV file
-csv_base_path = Path(args.csv)
-csv_base_name = csv_base_path.stem
-csv_extension = csv_base_path.suffix
-csv_dir = csv_base_path.parent
-
-# Process and sort all messages by timestamp for chronological export
-print("Retrieving and sorting messages by timestamp...")
-all_messages = list(db.rocketchat_message.find())
-messages = sorted(all_messages, key=lambda x: x.get('ts') if 'ts' in x else datetime.datetime.min)
-
-# Initialize CSV export variables
-message_count = 0
-csv_files_created = []
-channel_files = {}  # Dictionary to manage open file handles by channel
-
-print("Writing messages to channel-specific CSV files...")
-for msg in tqdm(messages):
-    if 'rid' not in msg or 'u' not in msg or 'ts' not in msg:
-        continue  # Skip incomplete messages
+    Args:
+        msgs: List of message documents from MESSAGE_PIPELINE, sorted by
+            timestamp, with the room, username and email already joined
+        with_json: Whether to also produce JSON lines
+        channel_cache: Maps room IDs to channel names; filled as rooms are seen
         
-    # Get timestamp as Unix timestamp
-    timestamp = int(msg['ts'].timestamp())
-    
-    # Get channel name from room map
-    channel = room_map.get(msg['rid'], f"unknown-{msg['rid']}")
-    
-    # Get username only
-    user_id = msg['u'].get('_id')
-    user_identifier = username_map.get(user_id, msg['u'].get('username', 'unknown-user'))
-    
-    # Process complete message content
-    text = process_message_content(msg)
-    
-    # Prepare text for CSV - may return multiple parts
-    text_parts = prepare_message_for_csv(text)
-    
-    # Check if we already have a file open for this channel
-    if channel not in channel_files:
-        # Create a new file for this channel
-        channel_file_path = csv_dir / f"{csv_base_name}_{channel}{csv_extension}"
-        channel_files[channel] = {
-            'file': open(channel_file_path, 'w', newline='', encoding='utf-8'),
-            'writer': None,
-            'path': channel_file_path
-        }
-        channel_files[channel]['writer'] = csv.writer(channel_files[channel]['file'], quoting=csv.QUOTE_MINIMAL)
-        channel_files[channel]['writer'].writerow(['timestamp', 'channel', 'username', 'text'])
-        csv_files_created.append(channel_file_path)
-    
-    # Write all message parts to the channel's CSV file
-    for part in text_parts:
-        channel_files[channel]['writer'].writerow([timestamp, channel, user_identifier, part])
-        message_count += 1
-        stats["messages"]["mongodb"] += 1
-
-# Close all open CSV files
-for channel_info in channel_files.values():
-    channel_info['file'].close()
-
-print(f"Wrote {message_count} message rows across {len(csv_files_created)} CSV files:")
-for f in csv_files_created:
-    print(f"  - {f}")
-
-# Export Phase 4: Messages to JSON format
-print("\\nPhase 4: Exporting messages to JSON format...")
-
-# Configuration for JSON export processing
-CHUNK_SIZE = 1000  # Process messages in batches for memory efficiency
-
-# Get total message count for progress tracking
-total_messages = db.rocketchat_message.count_documents({})
-processed_messages = 0
-
-# Set up JSON output directory
-json_out_dir = Path(args.json_dir).expanduser()
-json_out_dir.mkdir(parents=True, exist_ok=True)
-
-# Process messages in chunks to manage memory usage
-for chunk_start in tqdm(range(0, total_messages, CHUNK_SIZE)):
-    # Retrieve a batch of messages sorted by timestamp
-    message_chunk = list(db.rocketchat_message.find().sort("ts", ASCENDING).skip(chunk_start).limit(CHUNK_SIZE))
-    
-    # Convert messages to JSON format
+    Returns:
+        tuple: (csv_rows, row_count, json_lines) where csv_rows maps channel
+        names to encoded CSV rows in timestamp order, row_count is the number
+        of CSV rows and json_lines is a list of encoded JSON lines
+    """
+    csv_rows = {}
+    row_count = 0
     json_lines = []
-    for msg in message_chunk:
-        if 'rid' not in msg or 'u' not in msg or 'ts' not in msg:
-            continue  # Skip incomplete messages
+    for msg in msgs:
+        # Get timestamp as Unix timestamp
+        timestamp = to_epoch(msg['ts'])
         
-        # Map room ID to channel name
-        channel = room_map.get(msg['rid'], f"unknown-{msg['rid']}")
+        # Get channel name from the joined room, once per room
+        rid = msg['rid']
+        channel = channel_cache.get(rid)
+        if channel is None:
+            room = msg.get('room')
+            channel = channel_cache[rid] = channel_name(room) if room else f"unknown-{rid}"
         
-        # Get user identifier (prefer email, fallback to username)
-        user_id = msg['u'].get('_id')
-        user_identifier = email_map.get(user_id) if user_id in email_map else username_map.get(user_id, msg['u'].get('username', 'unknown-user'))
+        # Get username only (resolved by the pipeline)
+        user_identifier = msg['username']
         
         # Process complete message content (text, attachments, reactions, etc.)
         text = process_message_content(msg)
         
-        # Create JSON object for this message
+        # Prepare text for CSV - may return multiple parts
+        text_parts = prepare_message_for_csv(text)
+        
+        buf = csv_rows.get(channel)
+        if buf is None:
+            buf = csv_rows[channel] = bytearray()
+        for part in text_parts:
+            buf += format_csv_row(timestamp, channel, user_identifier, part).encode('utf-8')
+        row_count += len(text_parts)
+        
+        if not with_json:
+            continue
+        
+        # Create JSON object for this message (prefer email, fallback to username)
         json_obj = {
-            "timestamp": int(msg['ts'].timestamp()),
+            "timestamp": timestamp,
             "channel": channel,
-            "username": user_identifier,
+            "username": msg.get('email', user_identifier),
             "text": text
         }
-        
-        json_lines.append(json.dumps(json_obj))
-    
-    # Write this batch to a numbered JSON file
-    json_chunk_file = json_out_dir / f"messages_{chunk_start // CHUNK_SIZE + 1}.json"
-    with open(json_chunk_file, 'w', encoding='utf-8') as f:
-        f.write("\\n".join(json_lines) + "\\n")
+        json_lines.append(encode_json(json_obj) + b"\n")
     
-    processed_messages += len(message_chunk)
+    return csv_rows, row_count, json_lines
+
+def iter_batches(iterable, size):
+    """Yield successive lists of up to size items from iterable"""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+# ---------- Main Script ----------
+def main():
+    """Export users, rooms and messages from Rocket.Chat to Slack import files"""
+    # Parse command line arguments
+    ap = argparse.ArgumentParser(description="Convert Rocket.Chat data to Slack import format")
+    ap.add_argument("--mongo", default="mongodb://localhost:27017",
+                    help="MongoDB connection URI (default: mongodb://localhost:27017)")
+    ap.add_argument("--db", default="rocketchat",
+                    help="Database name containing Rocket.Chat collections (default: rocketchat)")
+    ap.add_argument("--out", default="./slack_export_core",
+                    help="Output directory for Slack import JSON files (default: ./slack_export_core)")
+    ap.add_argument("--csv", default="./messages_export.csv",
+                    help="Output CSV file for messages (default: ./messages_export.csv)")
+    ap.add_argument("--json-dir", default=None,
+                    help="Output directory for JSON message files (optional)")
+    args = ap.parse_args()
+
+    # Initialize output directories and database connection
+    out_dir = Path(args.out).expanduser()
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    client = MongoClient(args.mongo)
+    db = client[args.db]
+
+    # Display diagnostic information about the database
+    print(f"Connected to database: {args.mongo}/{args.db}")
+    print(f"Available collections: {', '.join(db.list_collection_names())}")
+    # Counts come from collection metadata, which avoids a full collection scan
+    total_messages = db.rocketchat_message.estimated_document_count()
+    print(f"Total users: {db.users.estimated_document_count()}")
+    print(f"Total rooms: {db.rocketchat_room.estimated_document_count()}")
+    print(f"Total messages: {total_messages}")
+
+    # Make sure the message sort is served by an index; restored dumps do not
+    # always carry Rocket.Chat's indexes. The $lookup joins match on _id, which
+    # is always indexed. A missing index only costs speed, so failures (e.g. a
+    # read-only account) are logged rather than stopping the export.
+    try:
+        db.rocketchat_message.create_index([("ts", ASCENDING)])
+    except pymongo.errors.OperationFailure as e:
+        logger.warning(f"Could not create index on rocketchat_message.ts: {e}")
+
+    # Export Phase 1: Users to Slack format
+    print("\\nPhase 1: Exporting users to Slack format...")
+    slack_users = []
+    uid_map = {}  # Maps Rocket.Chat user IDs to Slack user IDs
+    for idx, u in enumerate(tqdm(db.users.find({}, USER_FIELDS).sort("username", ASCENDING)), 1):
+        entry = make_user_entry(u, idx)
+        slack_users.append(entry)
+        uid_map[u["_id"]] = entry["id"]
+    stats["users"] = len(slack_users)
+
+    (out_dir / "users.json").write_text(json.dumps(slack_users, indent=2))
+
+    # Export Phase 2: Rooms/Channels to Slack format
+    print("\\nPhase 2: Exporting rooms and channels...")
+    # Categorize rooms by type for Slack import
+    rooms_by_type = {
+        "channels.json": [],  # Public channels
+        "groups.json": [],    # Private groups  
+        "dms.json": [],       # Direct messages
+        "mpims.json": []      # Multi-party instant messages
+    }
 
-print(f"\\nExport completed successfully!")
-print(f"Messages exported to JSON: {processed_messages}")
-print(f"JSON files created: {len(list(json_out_dir.glob('messages_*.json')))}")
+    # Process each room and categorize by type
+    for r in tqdm(db.rocketchat_room.find({}, ROOM_FIELDS)):
+        if r["t"] == "c":                     # public channel
+            rooms_by_type["channels.json"].append(make_room_entry(r, False))
+        elif r["t"] == "p":                   # private group
+            rooms_by_type["groups.json"].append(make_room_entry(r, True))
+        elif r["t"] == "d":                   # direct message
+            rooms_by_type["dms.json"].append(make_room_entry(r, True))
+        elif r["t"] == "l":                   # group DM (livechat/mpim)
+            rooms_by_type["mpims.json"].append(make_room_entry(r, True))
+
+    # Record room counts once, rather than updating stats for every room
+    stats["channels"].update({
+        "public": len(rooms_by_type["channels.json"]),
+        "private": len(rooms_by_type["groups.json"]),
+        "dm": len(rooms_by_type["dms.json"]),
+        "group_dm": len(rooms_by_type["mpims.json"])
+    })
+
+    # Write room data to separate JSON files
+    for filename, data in rooms_by_type.items():
+        if data:
+            (out_dir / filename).write_text(json.dumps(data, indent=2))
+
+    # Export Phase 3: Messages to CSV and JSON format
+    print("\\nPhase 3: Exporting messages to CSV and JSON format...")
+
+    # Configuration for CSV file organization
+    ROWS_PER_FILE = 2000  # Maximum rows per CSV file
+    MESSAGE_BATCH_SIZE = 6000  # Documents fetched per round-trip on message cursors
+    CSV_FLUSH_BYTES = 1 << 20  # Bytes buffered per channel before writing them out
+    CSV_BUFFER_BUDGET = 64 << 20  # Bytes buffered across all channels before flushing the largest
+    CSV_HEADER = b"timestamp,channel,username,text\n"
+    MAX_OPEN_FILES = 256  # Channel CSV files kept open at once
+    csv_base_path = Path(args.csv)
+    csv_base_name = csv_base_path.stem
+    csv_extension = csv_base_path.suffix
+    csv_dir = csv_base_path.parent
+
+    # Configuration for JSON export processing
+    CHUNK_SIZE = 1000  # Messages per JSON file
+    JSON_FILE_BUFFER = 1 << 20  # 1 MiB write buffer for the current JSON file
+
+    # Set up JSON output directory (JSON export is optional)
+    json_out_dir = Path(args.json_dir).expanduser() if args.json_dir else None
+    if json_out_dir:
+        json_out_dir.mkdir(parents=True, exist_ok=True)
+
+    # Let MongoDB sort messages by timestamp (backed by an index) and join each
+    # message with its room and author on the server, so only the fields the
+    # export needs are sent back and no client-side lookup tables are required
+    MESSAGE_PIPELINE = [
+        # Skip incomplete messages on the server side
+        {"$match": {"rid": {"$exists": True}, "u": {"$exists": True}, "ts": {"$exists": True}}},
+        {"$sort": {"ts": ASCENDING}},
+        {"$project": MESSAGE_FIELDS},
+        {"$lookup": {"from": "rocketchat_room", "localField": "rid", "foreignField": "_id",
+                     "as": "_room", "pipeline": [{"$project": {"name": 1, "usernames": 1}}]}},
+        {"$lookup": {"from": "users", "localField": "u._id", "foreignField": "_id",
+                     "as": "_user", "pipeline": [{"$project": {
+                         "username": 1,
+                         # emails is stored either as a list or as {"0": {...}}
+                         "email": {"$cond": [{"$isArray": "$emails"},
+                                             {"$arrayElemAt": ["$emails.address", 0]},
+                                             "$emails.0.address"]}}}]}},
+        {"$project": {
+            "_id": 0, "rid": 1, "ts": 1, "msg": 1, "attachments": 1,
+            "file": 1, "files": 1, "reactions": 1,
+            "room": {"$arrayElemAt": ["$_room", 0]},
+            "username": {"$ifNull": [{"$arrayElemAt": ["$_user.username", 0]},
+                                     "$u.username", "unknown-user"]},
+            "email": {"$arrayElemAt": ["$_user.email", 0]},
+        }},
+    ]
+
+    print("Retrieving messages sorted by timestamp...")
+    messages = db.rocketchat_message.aggregate(MESSAGE_PIPELINE, allowDiskUse=True,
+                                               batchSize=MESSAGE_BATCH_SIZE)
+
+    # Initialize CSV export variables
+    message_count = 0
+    csv_files_created = []
+    channel_files = {}  # Dictionary to manage output buffers by channel
+    open_fds = OrderedDict()  # Open CSV file descriptors by channel, least recently used first
+    csv_buffered = 0  # Bytes currently buffered across all channels
+
+    # Initialize JSON export variables
+    processed_messages = 0
+    json_file = None  # JSON file currently being written, opened on demand
+    json_file_count = 0
+    chunk_number = 0
+
+    # Write CSV and JSON output in a single pass over the message collection
+    print("Writing messages to channel-specific CSV files and JSON chunks...")
+    with_json = json_out_dir is not None
+    channel_cache = {}  # Maps room IDs to channel names
+    # The total is approximate (it includes incomplete messages) and only drives the progress bar
+    batches = iter_batches(tqdm(messages, total=total_messages, unit="msg"), MESSAGE_BATCH_SIZE)
+    with messages:
+        for msgs in batches:
+            csv_rows, row_count, json_lines = format_message_batch(msgs, with_json, channel_cache)
+            for channel, rows in csv_rows.items():
+                # Check if we already have a file for this channel
+                if channel not in channel_files:
+                    # Start a new file for this channel; it is opened on first flush
+                    channel_file_path = csv_dir / f"{csv_base_name}_{channel}{csv_extension}"
+                    channel_files[channel] = {
+                        'buf': bytearray(CSV_HEADER),
+                        'path': channel_file_path,
+                        'opened': False
+                    }
+                    csv_files_created.append(channel_file_path)
+                    csv_buffered += len(CSV_HEADER)
+
+                # Buffer the rows and write them to the channel's CSV file in batches
+                buf = channel_files[channel]['buf']
+                buf += rows
+                csv_buffered += len(rows)
+                if len(buf) >= CSV_FLUSH_BYTES:
+                    csv_buffered -= flush_channel(open_fds, channel_files, channel, MAX_OPEN_FILES)
+
+            # Keep memory bounded when many channels each hold a small buffer
+            if csv_buffered > CSV_BUFFER_BUDGET:
+                csv_buffered = flush_largest_channels(open_fds, channel_files, csv_buffered,
+                                                      CSV_BUFFER_BUDGET // 2, MAX_OPEN_FILES)
+
+            message_count += row_count
+
+            # Stream JSON lines into numbered files, moving to the next file
+            # every CHUNK_SIZE messages
+            for line in json_lines:
+                if json_file is None:
+                    chunk_number += 1
+                    json_file = open(json_out_dir / f"messages_{chunk_number}.json", 'wb',
+                                     buffering=JSON_FILE_BUFFER)
+                json_file.write(line)
+                json_file_count += 1
+                processed_messages += 1
+
+                if json_file_count >= CHUNK_SIZE:
+                    json_file.close()
+                    json_file = None
+                    json_file_count = 0
+
+    # Flush any buffered rows and close all open CSV files
+    for channel in channel_files:
+        flush_channel(open_fds, channel_files, channel, MAX_OPEN_FILES)
+    for fd in open_fds.values():
+        os.close(fd)
+
+    # Close the last, partially filled JSON file
+    if json_file is not None:
+        json_file.close()
+
+    stats["messages"]["mongodb"] = message_count
+    stats["messages"]["json_files"] = processed_messages
+
+    print(f"Wrote {message_count} message rows across {len(csv_files_created)} CSV files:")
+    for f in csv_files_created:
+        print(f"  - {f}")
+
+    print(f"\\nExport completed successfully!")
+    if json_out_dir:
+        print(f"Messages exported to JSON: {processed_messages}")
+        print(f"JSON files created: {chunk_number}")
+
+if __name__ == "__main__":
+    main()